@@ -1,8 +1,18 @@
 
+import hashlib
 import io
+import json
+import os
+import re
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
 import numpy as np
 import pandas as pd
 import streamlit as st
+import xlsxwriter
 
 st.set_page_config(page_title="阶梯定价 & 报价工具", layout="wide")
 
@@ -12,20 +22,6 @@ st.caption("上传工厂面价表（Excel），选择产品与型号，配置运
 # -----------------------------
 # Helpers
 # -----------------------------
-def coerce_numeric(x):
-    try:
-        # remove common currency/unit artifacts
-        if isinstance(x, str):
-            s = x.strip().replace(',', '')
-            # handle trailing non-numeric
-            s = ''.join(ch for ch in s if (ch.isdigit() or ch in '.-'))
-            if s == '' or s == '-' or s == '.':
-                return np.nan
-            return float(s)
-        return float(x)
-    except Exception:
-        return np.nan
-
 def tidy_sheet(df: pd.DataFrame):
     """
     Try to clean the sheet so that the first column acts as the 'MODEL' key
@@ -61,55 +57,295 @@ def tidy_sheet(df: pd.DataFrame):
             # still rename the first col to MODEL, keep old in col_meta
             df.rename(columns={df.columns[0]: "MODEL"}, inplace=True)
 
-    # Trim strings in MODEL
-    df["MODEL"] = df["MODEL"].astype(str).str.strip()
+    # Trim strings in MODEL; store them Arrow-backed (contiguous buffers, fast equality)
+    model = df["MODEL"].astype(str).str.strip()
+    try:
+        model = model.astype("string[pyarrow]")
+    except ImportError:
+        pass
+    df["MODEL"] = model
     # Coerce all other columns numeric where possible
     value_cols = [c for c in df.columns if c != "MODEL"]
     for c in value_cols:
-        df[c] = df[c].apply(coerce_numeric)
+        if pd.api.types.is_numeric_dtype(df[c]):
+            continue
+        if pd.api.types.is_datetime64_any_dtype(df[c]) or pd.api.types.is_timedelta64_dtype(df[c]):
+            # dates are not prices; to_numeric would turn them into epoch integers
+            df[c] = np.nan
+            continue
+        num = pd.to_numeric(df[c], errors="coerce")
+        # remove common currency/unit artifacts, only from text cells that failed to convert
+        missed = df[c][num.isna()]
+        text = missed[missed.map(lambda x: isinstance(x, str))]
+        if not text.empty:
+            # NFKC folds full-width digits / punctuation ("１，２３４．５") to ASCII first
+            s = text.str.normalize("NFKC").str.strip().str.replace(',', '', regex=False)
+            s = s.str.replace(r'[^0-9.\-]', '', regex=True).replace({'': None, '-': None, '.': None})
+            num.loc[text.index] = pd.to_numeric(s, errors="coerce")
+        df[c] = num
+    # Downcast prices to float32 (half the memory) only where that is lossless: every value
+    # has at most 4 decimals and survives the round trip, so resolve_prices' round(4) on
+    # upcast restores it exactly. Columns needing more precision stay float64.
+    for c in value_cols:
+        f64 = df[c].to_numpy(dtype="float64")
+        f32 = f64.astype("float32")
+        f64_4dp = f64.round(4)
+        if (np.array_equal(f64_4dp, f64, equal_nan=True)
+                and np.array_equal(f32.astype("float64").round(4), f64_4dp, equal_nan=True)):
+            df[c] = f32
     return df
 
-@st.cache_data(show_spinner=False)
-def load_all_sheets(file_bytes: bytes):
-    xls = pd.ExcelFile(io.BytesIO(file_bytes))
+def index_models(df: pd.DataFrame):
+    """
+    MODEL -> row position lookups for a tidied sheet, as (model_index, model_index_nospace),
+    so model_row / resolve_prices find a model with O(1) dict hits.
+    'model_index' is keyed on the stripped model, 'model_index_nospace' on the
+    model with all spaces removed (e.g. "4- 01" -> "4-01"). First occurrence wins.
+    Kept beside the DataFrame, not in df.attrs: pandas deep-copies attrs on every
+    derived frame/column and writes them into parquet metadata.
+    """
+    # normalized keys are built once per sheet, never per lookup
+    models = df["MODEL"].tolist()
+    nospace = df["MODEL"].str.replace(" ", "", regex=False).tolist()
+    # build from the bottom up so the first occurrence overwrites later duplicates
+    rows = range(len(models) - 1, -1, -1)
+    return dict(zip(reversed(models), rows)), dict(zip(reversed(nospace), rows))
+
+def open_workbook(file_bytes: bytes):
+    """
+    Open the workbook once; sheets are then parsed from this handle.
+    Prefers the calamine engine (Rust, streaming); falls back to pandas'
+    default engine (openpyxl / xlrd) if python-calamine is unavailable.
+    """
+    try:
+        return pd.ExcelFile(io.BytesIO(file_bytes), engine="calamine")
+    except (ImportError, ValueError):
+        return pd.ExcelFile(io.BytesIO(file_bytes))
+
+# On-disk cache of parsed sheets, keyed by the SHA-256 of the uploaded workbook.
+# Survives app restarts; the least recently used entries are pruned.
+# Only directories named <sha256> holding a sheets.json manifest are treated as entries.
+# Entries live under v<SHEET_CACHE_VERSION>/: bump it whenever tidy_sheet's output changes
+# so entries written by an older tree are never served.
+SHEET_CACHE_VERSION = 2  # 1 = the unversioned layout with entries directly under .sheet_cache/
+SHEET_CACHE_ROOT = Path(__file__).parent / ".sheet_cache"
+SHEET_CACHE_DIR = SHEET_CACHE_ROOT / f"v{SHEET_CACHE_VERSION}"
+SHEET_CACHE_MAX_ENTRIES = 20
+SHEET_CACHE_TMP_MAX_AGE = 3600  # seconds before an unfinished *.tmp entry counts as orphaned
+SHEET_CACHE_ENTRY_RE = re.compile(r"[0-9a-f]{64}")
+SHEET_CACHE_TMP_RE = re.compile(r"[0-9a-f]{64}\..+\.tmp")  # <sha256>.<random>.tmp from mkdtemp
+SHEET_CACHE_VERSION_RE = re.compile(r"v\d+")
+
+def read_sheet_cache(cache_dir: Path):
+    names = json.loads((cache_dir / "sheets.json").read_text(encoding="utf-8"))
+    sheets = {name: pd.read_parquet(cache_dir / f"{i}.parquet") for i, name in enumerate(names)}
+    os.utime(cache_dir)  # mark as recently used
+    return sheets
+
+def write_sheet_cache(cache_dir: Path, sheets):
+    # write into a private temp dir first so a half-written entry is never picked up,
+    # and concurrent writers of the same workbook never share files
+    cache_dir.parent.mkdir(parents=True, exist_ok=True)
+    tmp_dir = Path(tempfile.mkdtemp(dir=cache_dir.parent, prefix=f"{cache_dir.name}.", suffix=".tmp"))
+    try:
+        # sheet names may not be valid file names, so files are numbered and names kept in a manifest
+        for i, df in enumerate(sheets.values()):
+            df.to_parquet(tmp_dir / f"{i}.parquet", index=False)
+        (tmp_dir / "sheets.json").write_text(json.dumps(list(sheets.keys()), ensure_ascii=False), encoding="utf-8")
+        # fails if another session published the same entry first
+        tmp_dir.rename(cache_dir)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    prune_sheet_cache(cache_dir.parent)
+    drop_stale_cache_versions()
+
+def prune_sheet_cache(root: Path):
+    """LRU-prune our own entries and drop stale temp dirs; anything else in `root` is left alone."""
+    entries, now = [], time.time()
+    for d in root.iterdir():
+        if not d.is_dir():
+            continue
+        if SHEET_CACHE_TMP_RE.fullmatch(d.name):
+            # left behind by a failed rename / crashed writer
+            if now - d.stat().st_mtime > SHEET_CACHE_TMP_MAX_AGE:
+                shutil.rmtree(d, ignore_errors=True)
+        elif SHEET_CACHE_ENTRY_RE.fullmatch(d.name) and (d / "sheets.json").is_file():
+            entries.append(d)
+    entries.sort(key=lambda d: d.stat().st_mtime, reverse=True)
+    for d in entries[SHEET_CACHE_MAX_ENTRIES:]:
+        shutil.rmtree(d, ignore_errors=True)
+
+def drop_stale_cache_versions():
+    """
+    Remove v<N>/ dirs of older versions and pre-versioning entries left directly in the root.
+    Newer versions are kept: during a rolling deploy they belong to the newer process.
+    """
+    for d in SHEET_CACHE_ROOT.iterdir():
+        if not d.is_dir():
+            continue
+        older = SHEET_CACHE_VERSION_RE.fullmatch(d.name) and int(d.name[1:]) < SHEET_CACHE_VERSION
+        if older or SHEET_CACHE_ENTRY_RE.fullmatch(d.name) or SHEET_CACHE_TMP_RE.fullmatch(d.name):
+            shutil.rmtree(d, ignore_errors=True)
+
+def parse_all_sheets(file_bytes: bytes):
+    xls = open_workbook(file_bytes)
     sheets = {}
     for name in xls.sheet_names:
         try:
-            df = pd.read_excel(io.BytesIO(file_bytes), sheet_name=name, header=0)
+            df = xls.parse(name, header=0)
         except Exception:
-            df = pd.read_excel(io.BytesIO(file_bytes), sheet_name=name, header=None)
+            df = xls.parse(name, header=None)
         sheets[name] = tidy_sheet(df)
     return sheets
 
-def get_price(sheets_dict, sheet_name, product_col, model_code):
-    df = sheets_dict[sheet_name]
+def read_or_parse_sheets(file_hash: str, file_bytes: bytes):
+    cache_dir = SHEET_CACHE_DIR / file_hash
+    if cache_dir.is_dir():
+        try:
+            return read_sheet_cache(cache_dir)
+        except Exception:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+    sheets = parse_all_sheets(file_bytes)
+    try:
+        write_sheet_cache(cache_dir, sheets)
+    except Exception:
+        # caching is best-effort (read-only FS, pyarrow missing, odd column names...)
+        pass
+    return sheets
+
+@st.cache_resource(show_spinner=False)
+def load_all_sheets(file_hash: str, _file_bytes: bytes):
+    """
+    Parsed sheets for the workbook whose SHA-256 is `file_hash`, plus
+    {sheet: index_models(df)} for O(1) MODEL lookups.
+    `_file_bytes` is not hashed by Streamlit; the hex digest is the cache key.
+    Cached as a resource: the same objects are handed out without pickling/copying
+    the DataFrames on every rerun, so callers must treat them as read-only.
+    """
+    sheets = read_or_parse_sheets(file_hash, _file_bytes)
+    return sheets, {name: index_models(df) for name, df in sheets.items()}
+
+def model_row(sheet_index, model_code):
+    """Row position of `model_code` given a sheet's index_models() pair, or None."""
+    model_index, model_index_nospace = sheet_index
     # exact match first
-    row = df.loc[df["MODEL"].astype(str).str.strip()==str(model_code).strip()]
-    if row.empty:
+    idx = model_index.get(str(model_code).strip())
+    if idx is None:
         # try normalize like "4- 01" -> "4-01"
-        m = str(model_code).replace(" ", "")
-        row = df.loc[df["MODEL"].astype(str).str.replace(" ", "")==m]
-    if row.empty:
-        return np.nan
+        idx = model_index_nospace.get(str(model_code).replace(" ", ""))
+    return idx
+
+@st.cache_data(show_spinner=False)
+def resolve_prices(_sheets_dict, _model_index, file_hash: str, sheet_name, product_col, models: tuple) -> np.ndarray:
+    """
+    Face prices for `models` from one sheet/product column. Cached on
+    (file_hash, sheet, column, models) so widget changes that leave the
+    order lines untouched do not re-resolve prices.
+    """
+    df = _sheets_dict[sheet_name]
     if product_col not in df.columns:
-        return np.nan
-    return row.iloc[0][product_col]
+        return np.full(len(models), np.nan)
+    # repeated models (e.g. quantity splits) are looked up once
+    sheet_index = _model_index[sheet_name]
+    found = {m: model_row(sheet_index, m) for m in dict.fromkeys(models)}
+    rows = np.array([-1 if found[m] is None else found[m] for m in models], dtype=np.intp)
+    # gather from the price column's contiguous array in one take (row -1 hits the
+    # trailing NaN), upcast for the cost math
+    col = df[product_col]
+    prices = np.append(col.to_numpy(dtype=float), np.nan)[rows]
+    if col.dtype == np.float32:
+        # drop float32 noise; tidy_sheet only downcasts columns that are exact at 4 decimals
+        prices = prices.round(4)
+    return prices
 
 def price_with_margin(unit_cost, fixed_cost_per_order, qty, margin_pct, margin_mode="Revenue margin"):
     """
+    Vectorized: array arguments broadcast against each other.
     margin_mode:
       - 'Revenue margin' : price = (cost + fixed/qty) / (1 - m)
       - 'Markup on cost' : price = (cost + fixed/qty) * (1 + m)
+    Returns (price, unit all-in cost); price is NaN where a revenue margin is >= 100%.
     """
-    unit_allin_cost = unit_cost + (fixed_cost_per_order / max(qty,1))
-    m = margin_pct / 100.0
-    if margin_mode == "Markup on cost":
-        return unit_allin_cost * (1 + m), unit_allin_cost
-    else:
-        # Revenue margin
-        if (1 - m) <= 0:
-            return np.nan, unit_allin_cost
-        return unit_allin_cost / (1 - m), unit_allin_cost
+    unit_allin_cost = np.asarray(unit_cost + fixed_cost_per_order / np.maximum(qty, 1), dtype=float)
+    m = np.asarray(margin_pct, dtype=float) / 100.0
+    is_markup = np.asarray(margin_mode) == "Markup on cost"
+    with np.errstate(divide="ignore", invalid="ignore"):
+        price = np.where(is_markup, unit_allin_cost * (1 + m), unit_allin_cost / np.where(1 - m > 0, 1 - m, np.nan))
+    return price, unit_allin_cost
+
+def tier_table(calc_df: pd.DataFrame, tiers: pd.DataFrame, fixed_cost_total, total_qty, currency):
+    """
+    Long-form tier quote: one row per (order line, tier). Deliberately not cached:
+    hashing the frames and unpickling a hit costs more than this vectorized math.
+    """
+    cost = calc_df["给我成本(面价×系数)"].to_numpy(dtype=float)
+    qty_share = calc_df["数量"].to_numpy(dtype=float) / max(total_qty, 1.0)
+    min_qty = tiers["min_qty"].to_numpy().astype(int)
+    tier_modes = tiers["margin_mode"].to_numpy()
+    tier_pct = tiers["margin_pct"].to_numpy(dtype=float)
+    # Broadcast lines (rows) against tiers (columns). Each line carries its proportional
+    # share of the fixed cost, spread over the tier's quantity (>=1) for preview.
+    tier_price, unit_allin = price_with_margin(
+        unit_cost=cost[:, None],
+        fixed_cost_per_order=fixed_cost_total * qty_share[:, None],
+        qty=min_qty[None, :],
+        margin_pct=tier_pct[None, :],
+        margin_mode=tier_modes[None, :]
+    )
+
+    n_lines, n_tiers = unit_allin.shape
+    return pd.DataFrame({
+        "line": np.repeat(calc_df["line"].to_numpy(), n_tiers),
+        "型号": np.repeat(calc_df["model"].to_numpy(), n_tiers),
+        "列": np.repeat(calc_df["product_col"].to_numpy(), n_tiers),
+        "阶梯起订量": np.tile(min_qty, n_lines),
+        "利润方式": np.tile(tier_modes, n_lines),
+        "利润%": np.tile(tier_pct, n_lines),
+        f"{currency}/件（含分摊固定成本）": np.round(tier_price, 4).ravel(),
+        "该档保本单价": np.round(unit_allin, 4).ravel(),
+    })
+
+def order_summary(calc_df: pd.DataFrame, fixed_cost_total, total_qty, target_margin_mode, target_margin_pct):
+    """Per-line quote at the target margin and each line's actual quantity."""
+    qty_arr = calc_df["数量"].to_numpy(dtype=float)
+    line_qty = qty_arr.astype(int)
+    fixed_share = fixed_cost_total * qty_arr / max(total_qty, 1.0)
+    order_price, order_allin = price_with_margin(
+        unit_cost=calc_df["给我成本(面价×系数)"].to_numpy(dtype=float),
+        fixed_cost_per_order=fixed_share,
+        qty=line_qty,
+        margin_pct=target_margin_pct,
+        margin_mode=target_margin_mode
+    )
+
+    return pd.DataFrame({
+        "line": calc_df["line"].to_numpy(),
+        "型号": calc_df["model"].to_numpy(),
+        "列": calc_df["product_col"].to_numpy(),
+        "数量": line_qty,
+        "保本单价": np.round(order_allin, 4),
+        f"目标{target_margin_pct:.1f}%单价": np.round(order_price, 4),
+        "小计(目标)": np.round(order_price * qty_arr, 2)
+    })
+
+def write_excel(frames) -> bytes:
+    """
+    Write each DataFrame to its own sheet using xlsxwriter's constant_memory mode,
+    which flushes every row to disk as soon as the next one starts. That only works
+    when cells arrive row by row; pandas' to_excel writes column by column, so rows
+    are streamed here directly.
+    """
+    buffer = io.BytesIO()
+    with xlsxwriter.Workbook(buffer, {"constant_memory": True, "nan_inf_to_errors": True}) as wb:
+        for name, df in frames.items():
+            ws = wb.add_worksheet(name[:31] or "Sheet")
+            ws.write_row(0, 0, [str(c) for c in df.columns])
+            # NaN -> None (blank cell), numpy scalars -> Python scalars
+            values = df.astype(object).where(df.notna(), None)
+            for r, row in enumerate(values.itertuples(index=False, name=None), start=1):
+                ws.write_row(r, 0, row)
+    return buffer.getvalue()
 
 # -----------------------------
 # Sidebar: Data & Global Config
@@ -135,8 +371,12 @@ elif default_bytes is not None:
 if not file_bytes:
     st.stop()
 
-sheets_dict = load_all_sheets(file_bytes)
+file_hash = hashlib.sha256(file_bytes).hexdigest()
+sheets_dict, model_index = load_all_sheets(file_hash, file_bytes)
 sheet_names = list(sheets_dict.keys())
+# per-sheet column metadata, computed once instead of per order line
+value_cols_by_sheet = {s: [c for c in d.columns if c!="MODEL"] for s, d in sheets_dict.items()}
+col_sets = {s: set(d.columns) for s, d in sheets_dict.items()}
 st.sidebar.success(f"已读取 {len(sheet_names)} 个Sheet：{', '.join(sheet_names)}")
 
 st.sidebar.header("2) 成本与费用设置")
@@ -168,13 +408,13 @@ with colA:
     st.write("选择对应Sheet、产品列与型号，然后输入数量。")
     # Prepare a pool of choices
     default_sheet = sheet_names[0]
-    default_cols = [c for c in sheets_dict[default_sheet].columns if c!="MODEL"]
+    default_cols = value_cols_by_sheet[default_sheet]
 
 # Prepare an editable grid for order items
 if "order_df" not in st.session_state:
     # seed with two example lines; user can adjust to真实型号/列名
     example_sheet = sheet_names[0]
-    example_cols = [c for c in sheets_dict[example_sheet].columns if c!="MODEL"]
+    example_cols = value_cols_by_sheet[example_sheet]
     c1 = example_cols[0] if example_cols else ""
     c2 = example_cols[1] if len(example_cols)>1 else c1
     st.session_state.order_df = pd.DataFrame({
@@ -197,35 +437,45 @@ order_df = st.data_editor(
 if order_df.empty:
     st.stop()
 
-calc_rows = []
-total_qty = 0
-for i, r in order_df.iterrows():
-    sheet = r.get("sheet", sheet_names[0])
+def resolve_product_col(sheet, product_col):
     if sheet not in sheets_dict:
-        base_price = np.nan
-    else:
-        product_col = r.get("product_col", None)
-        model_code = r.get("model", "")
-        df_sheet = sheets_dict[sheet]
-        # If product_col invalid, try to guess first available column
-        if product_col not in df_sheet.columns:
-            value_cols = [c for c in df_sheet.columns if c!="MODEL"]
-            product_col = value_cols[0] if value_cols else None
-        base_price = get_price(sheets_dict, sheet, product_col, model_code)
-    qty = float(r.get("qty", 0) or 0)
-    total_qty += qty
-    cost_unit = (base_price or 0) * factory_discount
-    calc_rows.append({
-        "line": i+1,
-        "sheet": sheet,
-        "product_col": product_col,
-        "model": r.get("model",""),
-        "面价": base_price,
-        "给我成本(面价×系数)": cost_unit,
-        "数量": qty
+        return product_col
+    # If product_col invalid, try to guess first available column
+    if product_col not in col_sets[sheet]:
+        value_cols = value_cols_by_sheet[sheet]
+        product_col = value_cols[0] if value_cols else None
+    return product_col
+
+@st.cache_data(show_spinner=False)
+def resolve_costs(order_key: bytes, file_hash: str, factory_discount, _order_df: pd.DataFrame):
+    """
+    Line costs for the order grid. Keyed on a row hash of the grid plus the workbook
+    hash, so margin / tier / currency / VAT edits reuse the resolved prices.
+    """
+    # Parse the order grid column-wise, then resolve prices once per (sheet, product_col) group
+    sheets = _order_df["sheet"].tolist()
+    models = _order_df["model"].tolist()
+    product_cols = [resolve_product_col(s, c) for s, c in zip(sheets, _order_df["product_col"].tolist())]
+    lines = pd.DataFrame({"sheet": sheets, "product_col": product_cols, "model": models})
+    base_prices = np.full(len(lines), np.nan)
+    for (sheet, product_col), grp in lines.groupby(["sheet", "product_col"], sort=False):
+        if sheet in sheets_dict:
+            base_prices[grp.index.to_numpy()] = resolve_prices(sheets_dict, model_index, file_hash, sheet, product_col, tuple(grp["model"]))
+    qtys = pd.to_numeric(_order_df["qty"], errors="coerce").fillna(0).to_numpy(dtype=float)
+    return pd.DataFrame({
+        "line": np.arange(1, len(_order_df)+1),
+        "sheet": sheets,
+        "product_col": product_cols,
+        "model": models,
+        "面价": base_prices,
+        "给我成本(面价×系数)": base_prices * factory_discount,
+        "数量": qtys
     })
 
-calc_df = pd.DataFrame(calc_rows)
+# row hash of the grid: identical order lines -> cache hit in resolve_costs
+order_key = pd.util.hash_pandas_object(order_df, index=False).to_numpy().tobytes()
+calc_df = resolve_costs(order_key, file_hash, factory_discount, order_df)
+total_qty = calc_df["数量"].sum()
 
 st.subheader("行项成本（未分摊固定费用）")
 st.dataframe(calc_df, use_container_width=True)
@@ -244,63 +494,15 @@ st.dataframe(calc_df[["line","sheet","product_col","model","数量","面价","
 
 # Tiered pricing per line
 st.subheader("阶梯报价（按行计算）")
-tier_tables = []
-for i, r in calc_df.iterrows():
-    row_tables = []
-    for _, tr in tiers.iterrows():
-        min_qty = int(tr["min_qty"])
-        mode = tr["margin_mode"]
-        m = float(tr["margin_pct"])
-        # Use this tier's quantity (>=min_qty). For preview, we compute price at that exact qty and also show per-unit.
-        price_unit, unit_allin_cost = price_with_margin(
-            unit_cost=r["给我成本(面价×系数)"],
-            fixed_cost_per_order=fixed_cost_total * (r["数量"] / max(total_qty,1.0)),  # proportional share for preview
-            qty=max(min_qty,1),
-            margin_pct=m,
-            margin_mode=mode
-        )
-        row_tables.append({
-            "line": int(r["line"]),
-            "型号": r["model"],
-            "列": r["product_col"],
-            "阶梯起订量": min_qty,
-            "利润方式": mode,
-            "利润%": m,
-            f"{currency}/件（含分摊固定成本）": None if pd.isna(price_unit) else round(price_unit, 4),
-            "该档保本单价": round(unit_allin_cost, 4) if unit_allin_cost==unit_allin_cost else None
-        })
-    tt = pd.DataFrame(row_tables)
-    tier_tables.append(tt)
-
-if tier_tables:
-    show_tiers = pd.concat(tier_tables, ignore_index=True)
-    st.dataframe(show_tiers, use_container_width=True)
+show_tiers = tier_table(calc_df, tiers, fixed_cost_total, total_qty, currency)
+st.dataframe(show_tiers, use_container_width=True)
 
 # Order summary (at user-selected target margin & total order qty)
 st.subheader("整单汇总（以每行实际数量计算）")
 target_margin_mode = st.selectbox("整单目标利润方式", ["Revenue margin","Markup on cost"])
 target_margin_pct = st.number_input("整单目标利润（%）", min_value=0.0, max_value=99.0, value=25.0, step=0.5)
 
-order_rows = []
-for i, r in calc_df.iterrows():
-    unit_price, unit_allin = price_with_margin(
-        unit_cost=r["给我成本(面价×系数)"],
-        fixed_cost_per_order=fixed_cost_total * (r["数量"]/max(total_qty,1.0)),
-        qty=max(int(r["数量"]),1),
-        margin_pct=target_margin_pct,
-        margin_mode=target_margin_mode
-    )
-    order_rows.append({
-        "line": int(r["line"]),
-        "型号": r["model"],
-        "列": r["product_col"],
-        "数量": int(r["数量"]),
-        "保本单价": round(unit_allin,4) if unit_allin==unit_allin else None,
-        f"目标{target_margin_pct:.1f}%单价": round(unit_price,4) if unit_price==unit_price else None,
-        "小计(目标)": None if (unit_price!=unit_price) else round(unit_price*float(r["数量"]),2)
-    })
-
-order_df_priced = pd.DataFrame(order_rows)
+order_df_priced = order_summary(calc_df, fixed_cost_total, total_qty, target_margin_mode, target_margin_pct)
 total_target = order_df_priced["小计(目标)"].replace({np.nan:0}).sum()
 st.dataframe(order_df_priced, use_container_width=True)
 st.markdown(f"**整单目标金额：{currency} {total_target:,.2f}**")
@@ -309,14 +511,10 @@ st.markdown(f"**整单目标金额：{currency} {total_target:,.2f}**")
 st.subheader("导出")
 out = {
     "行项成本": calc_df,
-    "阶梯报价示例": show_tiers if tier_tables else pd.DataFrame(),
+    "阶梯报价示例": show_tiers,
     "整单报价": order_df_priced
 }
-buffer = io.BytesIO()
-with pd.ExcelWriter(buffer, engine="xlsxwriter") as writer:
-    for name, df in out.items():
-        df.to_excel(writer, index=False, sheet_name=name[:31] or "Sheet")
-st.download_button("下载Excel报价", data=buffer.getvalue(), file_name="报价结果.xlsx", mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+st.download_button("下载Excel报价", data=write_excel(out), file_name="报价结果.xlsx", mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
 
 st.divider()
 st.caption("提示：保本价 = （给我成本 + 固定成本/件）。若按**含税到岸**或其他条款计价，可在“成本与费用设置”中加入额外固定/变动项，并调整利润方式为“按营收利润率”或“按成本加成”。")